@@ -0,0 +1,12 @@
+import os
+import tempfile
+
+
+def pytest_configure(config):
+    """Keep the tests' temporary files in memory, where possible."""
+    # The tests create lots of small files and git repositories, which is much faster
+    # on a tmpfs. /dev/shm is one on most Linux systems; elsewhere (or if TMPDIR or
+    # --basetemp were given), the default temporary directory is used.
+    shm = "/dev/shm"
+    if "TMPDIR" not in os.environ and os.path.isdir(shm) and os.access(shm, os.W_OK):
+        tempfile.tempdir = shm
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import ast
+import contextlib
+import functools
 import hashlib
 import json
 import os
@@ -10,19 +12,24 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import strftime
 from typing import Any
 from typing import Dict
+from typing import IO
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
 from typing import Union
 
 import attr
 import click
-import yaml
 from click_help_colors import HelpColorsGroup
 
 from .utils import AppPaths
@@ -32,9 +39,79 @@ from .utils import Paths
 
 DEBUG: bool = False
 
+# The version of the cache file format. Bump this whenever the way hashes are computed
+# changes, so hashes from previous versions are never mistaken for current ones.
+CACHE_VERSION = 2
+
 MAX_GIT_NETWORK_ATTEMPTS = 3
 RETRY_WAIT_SECONDS = 10
 
+# The default maximum number of apps to process at the same time.
+MAX_WORKERS = 8
+
+# Matches Harbormaster variables in templates, like `{{ HM_FOO }}` or
+# `{{ HM_FOO:"default" }}`, capturing the name and the optional default. Whitespace
+# is allowed around the colon.
+_TEMPLATE_RE = re.compile(
+    r"{{\s*HM_(?P<name>[^\s:}]+)(?:\s*:\s*(?P<default>.*?))?\s*}}"
+)
+
+# The environment Harbormaster was started with, which commands inherit.
+_BASE_ENV = dict(os.environ)
+
+# Extra environment for Compose. BuildKit builds independent stages in parallel, and
+# older Docker versions don't enable it by default, so enable it unless the user has
+# configured it themselves.
+_COMPOSE_ENV = {} if "DOCKER_BUILDKIT" in _BASE_ENV else {"DOCKER_BUILDKIT": "1"}
+
+# The full paths of the executables we run, looked up once instead of searching the
+# PATH for each command. If they can't be found, we fall back to the plain names, so
+# running them fails the usual way.
+_DOCKER = shutil.which("docker") or "docker"
+_GIT = shutil.which("git") or "git"
+
+# Held while printing, so output from different threads doesn't get interleaved.
+_OUTPUT_LOCK = threading.Lock()
+
+# Holds each thread's output buffer, if its output is being buffered.
+_OUTPUT = threading.local()
+
+# Parsed environment/replacements files, keyed by (path, mtime, size), so that files
+# shared between apps are only parsed once.
+_VAR_FILE_CACHE: Dict[Tuple[Path, int, int], Dict[str, str]] = {}
+
+
+def echo(message: str) -> None:
+    """Print a message, making sure it doesn't interleave with other threads' output."""
+    buffer = getattr(_OUTPUT, "buffer", None)
+    if buffer is not None:
+        buffer.append(message)
+        return
+
+    with _OUTPUT_LOCK:
+        click.echo(message)
+
+
+@contextlib.contextmanager
+def _buffered_output(enabled: bool = True) -> Iterator[None]:
+    """
+    Buffer everything this thread echoes, and print it all at once at the end.
+
+    This keeps the output of each app together when processing apps in parallel.
+    """
+    if not enabled:
+        yield
+        return
+
+    _OUTPUT.buffer = []
+    try:
+        yield
+    finally:
+        lines, _OUTPUT.buffer = _OUTPUT.buffer, None
+        if lines:
+            with _OUTPUT_LOCK:
+                click.echo("\n".join(lines))
+
 
 def debug(message: str, force: bool = False) -> None:
     """Print a message if DEBUG is True."""
@@ -42,38 +119,70 @@ def debug(message: str, force: bool = False) -> None:
         # If there already is a newline, strip it.
         if message.endswith("\n"):
             message = message[:-1]
-        click.echo(message)
+        echo(message)
 
 
 def _hash_dict(d: Dict) -> str:
-    """Repeatably hash a dict."""
-    return hashlib.sha1(str(sorted(d.items())).encode()).hexdigest()
+    """
+    Repeatably hash a dict.
+
+    The hash is only used for change detection, so we use BLAKE2 over the canonical
+    JSON representation of the dict, which is fast and stable.
+    """
+    canonical = json.dumps(d, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_default(default: str) -> str:
+    """Parse the default value of a template variable."""
+    try:
+        return str(ast.literal_eval(default))
+    except Exception:
+        return "HM_INVALID_DEFAULT_VALUE"
+
+
+def _load_yaml(stream: Union[str, bytes, IO]) -> Any:
+    """
+    Parse YAML safely, using the libyaml-backed loader if it's available.
+
+    PyYAML is imported here instead of at the top of the module, so runs that don't
+    need to parse any YAML don't pay for importing it.
+    """
+    import yaml
+
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _dump_yaml(data: Any) -> str:
+    """Serialize data to YAML, using the libyaml-backed dumper if it's available."""
+    import yaml
+
+    return yaml.dump(data, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
 
 
 def _render_template(template: str, replacements: Dict[str, Any]) -> str:
-    """Render a template with the values in replacements."""
-    # Perform all defined replacements.
-    for varname, replacement in replacements.items():
-        template = re.sub(
-            r"{{\s*HM_%s(?:\:(.*?))?\s*}}" % varname,
-            str(replacement),
-            template,
-        )
+    """
+    Render a template with the values in replacements.
+
+    Defined variables are replaced with their values, undefined ones with their
+    defaults, and undefined ones without defaults are left as they are. This is done
+    in a single pass over the template, regardless of the number of replacements.
+    """
+    if "HM_" not in template:
+        # There's nothing to replace, so don't bother running the regex.
+        return template
 
     def replacement_fn(match: re.Match) -> str:
-        try:
-            value = str(ast.literal_eval(match.group(1)))
-        except Exception:
-            value = "HM_INVALID_DEFAULT_VALUE"
-        return value
-
-    # Replace all undefined replacements with their defaults.
-    template = re.sub(
-        r"{{\s*HM_(?:.*?)\:(.*?)\s*}}",
-        replacement_fn,
-        template,
-    )
-    return template
+        name, default = match["name"], match["default"]
+        if name in replacements:
+            return str(replacements[name])
+        elif default is not None:
+            return _parse_default(default)
+        else:
+            return match.group(0)
+
+    return _TEMPLATE_RE.sub(replacement_fn, template)
 
 
 def _read_var_file(
@@ -99,34 +208,106 @@ def _read_var_file(
             f'Environment or replacements file for app "{app_id}" '
             f"cannot be read, cannot continue:\n{f}"
         )
-    output = {}
-    contents = f.read_text()
 
+    stat = f.stat()
+    cache_key = (f, stat.st_mtime_ns, stat.st_size)
+    if cache_key in _VAR_FILE_CACHE:
+        # Return a copy, as callers update the dictionary in place.
+        return dict(_VAR_FILE_CACHE[cache_key])
+
+    output = {}
     if f.suffix.lower() in (".yml", ".yaml"):
         # This file is YAML.
+        error = ValueError(
+            f"{filename} is not valid YAML or does not contain "
+            "a single YAML collection of strings."
+        )
         try:
-            output = yaml.safe_load(contents)
-            assert isinstance(output, dict)
-            assert all(type(x) is str for x in output.keys())
-            assert all(type(x) is str for x in output.values())
-            # Convert everything to a string.
+            with f.open("rb") as infile:
+                output = _load_yaml(infile)
         except Exception:
-            raise ValueError(
-                f"{filename} is not valid YAML or does not contain "
-                "a single YAML collection of strings."
-            )
+            raise error
+        if not isinstance(output, dict):
+            raise error
+        for key, value in output.items():
+            if not (isinstance(key, str) and isinstance(value, str)):
+                raise error
     else:
-        for line in contents.split("\n"):
+        for line in f.read_text(encoding="utf-8").splitlines():
             if not line:
                 continue
-            if "=" not in line:
+            key, equals, value = line.partition("=")
+            if not equals:
                 sys.exit(
-                    f"Environment or replacements file for app {app_id} contained a "
-                    f"line without an equals sign (=), cannot continue:\n{f}"
+                    f"Environment or replacements file for app {app_id} contained "
+                    f"a line without an equals sign (=), cannot continue:\n{f}"
                 )
-            key, value = line.split("=", maxsplit=1)
             output[key] = value
-    return output
+
+    _VAR_FILE_CACHE[cache_key] = output
+    return dict(output)
+
+
+def _write_atomically(path: Path, contents: Union[str, bytes]) -> None:
+    """
+    Write a file atomically, by writing to a temporary file and renaming it.
+
+    Like writing in place would, this writes to the target of a symlink rather than
+    replacing the symlink, and keeps the permissions of an existing file.
+    """
+    path = path.resolve()
+    # Use a unique temporary file, so we don't clobber a file that happens to have the
+    # same name, or race with another run writing the same file.
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(contents.encode() if isinstance(contents, str) else contents)
+        try:
+            shutil.copymode(path, temp_name)
+        except FileNotFoundError:
+            # This is a new file, so there's no mode to keep.
+            pass
+        os.replace(temp_name, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_name)
+        raise
+
+
+def _load_config(config: Path, cache_file: Path) -> Dict[str, Any]:
+    """
+    Load the configuration file, using the cached parsed version if possible.
+
+    The parsed configuration is stored as JSON (which is much faster to load than
+    YAML), keyed by the configuration file's path, modification time and size.
+    """
+    stat = config.stat()
+    key = f"{config}:{stat.st_mtime_ns}:{stat.st_size}"
+    try:
+        # Anyone could have written a world-writable cache, so don't trust it.
+        if cache_file.stat().st_mode & 0o002:
+            raise ValueError("The configuration cache is world-writable.")
+        cached = json.loads(cache_file.read_bytes())
+        if cached["key"] == key:
+            debug("Loaded the configuration from the cache.")
+            return cached["data"]
+    except Exception:
+        # The cache is missing or invalid, so just parse the file.
+        pass
+
+    with config.open("rb") as infile:
+        configuration = _load_yaml(infile) or {}
+
+    try:
+        serialized = json.dumps({"key": key, "data": configuration})
+        # YAML supports types (like dates) that JSON doesn't, so only cache the
+        # configuration if it survives the round trip unchanged.
+        if json.loads(serialized)["data"] == configuration:
+            _write_atomically(cache_file, serialized)
+    except Exception as e:
+        debug(f"Could not write the configuration cache: {e}")
+
+    return configuration
 
 
 def _kill_orphan_containers(repo_id: str):
@@ -140,44 +321,107 @@ def _kill_orphan_containers(repo_id: str):
     That's because the configuration file might be missing, and we might
     not know what the compose file's name is.
     """
-    stdout = _run_command_full(
-        ["/usr/bin/env", "docker", "ps", "-qf", f"name={repo_id}_"],
+    # The name filter is a regular expression, so anchor it to only match containers
+    # whose names start with the repo ID.
+    stdout = _run_command_simple(
+        [_DOCKER, "ps", "-qf", f"name=^{re.escape(repo_id)}_"],
         Path("."),
     )[1]
-    if not stdout:
+    container_ids = stdout.decode().split()
+    if not container_ids:
         # `docker ps` returned nothing, ie nothing is running.
         return
 
-    container_ids = stdout.decode().strip().split("\n")
-    return_codes = []
-    for container_id in container_ids:
-        debug(f"Stopping container {container_id}...")
-        return_codes.append(
-            _run_command(["/usr/bin/env", "docker", "stop", container_id], Path("."))
-        )
-
-    if any(return_codes):
+    debug(f"Stopping containers {', '.join(container_ids)}...")
+    # `docker stop` accepts multiple containers and stops them in parallel, so stop
+    # them all with a single call.
+    if _run_command([_DOCKER, "stop", *container_ids], Path(".")):
         raise Exception("Could not stop some containers.")
 
 
+def _get_running_project_dirs() -> Optional[Set[str]]:
+    """
+    Return the working directories of all the Compose projects with running containers.
+
+    Compose labels all the containers it starts with their project's working
+    directory, so this gets the running projects for all apps with a single `docker ps`
+    call, instead of one call per app. The directory is used instead of the project
+    name, because the name can be set in the Compose file or in `.env`, whereas the
+    directory only depends on where the first Compose file is. Returns None if the
+    containers could not be listed.
+    """
+    returncode, stdout = _run_command_simple(
+        [
+            _DOCKER,
+            "ps",
+            "--filter",
+            "status=running",
+            "--format",
+            '{{.Label "com.docker.compose.project.working_dir"}}',
+        ],
+        Path("."),
+    )
+    if returncode != 0:
+        return None
+
+    return {
+        os.path.normpath(line.strip())
+        for line in stdout.decode().split("\n")
+        if line.strip()
+    }
+
+
+def _read_git_ref(repo_dir: Path, ref: str) -> str:
+    """
+    Return the commit SHA a ref (like `HEAD` or `refs/heads/main`) points to.
+
+    The ref is read from disk, which avoids spawning git just to read a file. Raises
+    an exception if the SHA can't be determined this way (e.g. for unusual repository
+    layouts).
+    """
+    git_dir = repo_dir / ".git"
+    ref_file = git_dir / ref
+    if ref_file.is_file():
+        sha = ref_file.read_text().strip()
+    else:
+        # The ref isn't loose, so look for it in the packed refs.
+        for line in (git_dir / "packed-refs").read_text().splitlines():
+            sha, _, name = line.partition(" ")
+            if name == ref:
+                break
+        else:
+            raise ValueError(f"Could not find ref {ref}.")
+
+    if sha.startswith("ref: "):
+        # This is a symbolic ref (like `HEAD` usually is), so follow it.
+        return _read_git_ref(repo_dir, sha[len("ref: ") :])
+
+    if not re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", sha):
+        raise ValueError(f"Invalid SHA for {ref}: {sha}")
+    return sha
+
+
+def _read_git_head(repo_dir: Path) -> str:
+    """Return the commit SHA a repository's HEAD points to, by reading it from disk."""
+    return _read_git_ref(repo_dir, "HEAD")
+
+
 def _run_command_full(
     command: List[Union[str, Path]],
     chdir: Path,
     environment: Optional[Dict[str, str]] = None,
     print_output: bool = False,
+    capture: bool = True,
 ) -> Tuple[int, bytes]:
-    """Run a command and return its exit code, stdout, and stderr."""
-    # Include the environment in our command.
-    env = os.environ.copy()
-    if environment:
-        env.update(environment)
-
-    wd = os.getcwd()
-    os.chdir(chdir)
-    # We concatenate the command here instead of just passing it to Popen, because the
-    # Harbormaster container (the way to deploy HM) uses a symlink inside with the same
-    # name as the host directory (to make the paths inside the container match up with
-    # the host).
+    """
+    Run a command and return its exit code, stdout, and stderr.
+
+    If `capture` is False, the output is discarded (unless it's being shown), and the
+    returned output is empty.
+    """
+    # The Harbormaster container (the way to deploy HM) uses a symlink inside with the
+    # same name as the host directory (to make the paths inside the container match up
+    # with the host).
     #
     # We do this because otherwise relative volume paths (e.g. `.:/code`) don't work,
     # as it tries to map the current directory inside the container (e.g. `/main`) to
@@ -185,47 +429,98 @@ def _run_command_full(
     # a symlink called `/home/foo/hm` inside the container, with `/main` as a target.
     #
     # In order for Compose to see the current directory as the symlink (ie
-    # `/home/foo/hm`), instead of the absolute path (ie `/main`), we need to use a shell
-    # and cd to the symlink before running Compose.
+    # `/home/foo/hm`), instead of the absolute path (ie `/main`), we set `PWD` to the
+    # symlink, the same way a shell would if it cd'd into it. Compose uses `PWD` as the
+    # working directory as long as it points to the actual working directory.
     #
-    # I haven't found another way to do this, but if you do, feel free to change it.
-    concatenated_command = f"cd {shlex.quote(str(chdir))}; " + " ".join(
-        [shlex.quote(str(c)) for c in command]
-    )
-    debug(f"Command: {concatenated_command}")
-    process = subprocess.Popen(
-        concatenated_command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        env=env,
-        shell=True,
-    )
+    # Commands without an environment of their own (which never include Compose) just
+    # inherit ours, which saves building a new environment for each of them.
+    env: Optional[Dict[str, str]] = None
+    if environment is not None:
+        env = {**_BASE_ENV, **environment, "PWD": str(chdir)}
+
+    # If nobody is going to look at the output, send it straight to /dev/null instead
+    # of holding it in memory, as build logs can be quite large.
+    stream_output = DEBUG or print_output
+    discard_output = not capture and not stream_output
+
+    args = [str(c) for c in command]
+    if DEBUG:
+        # Quoting the command isn't free, so only do it if it's going to be shown.
+        debug(f"Command: cd {shlex.quote(str(chdir))}; {shlex.join(args)}")
+    try:
+        process = subprocess.Popen(
+            args,
+            stdout=subprocess.DEVNULL if discard_output else subprocess.PIPE,
+            stderr=subprocess.DEVNULL if discard_output else subprocess.STDOUT,
+            env=env,
+            # Don't change our own working directory, as commands might be running in
+            # other threads.
+            cwd=chdir,
+        )
+    except FileNotFoundError as e:
+        # Fail the same way a shell would if the command could not be found.
+        debug(f"Return code: 127\n{e}")
+        return (127, str(e).encode())
 
-    stdout_list: List[bytes] = []
-    if process.stdout:
-        try:
-            for line in process.stdout:
-                stdout_list.append(line)
-                debug(line.decode(), force=print_output)
-        except KeyboardInterrupt as e:
-            os.kill(process.pid, signal.SIGINT)
+    try:
+        if discard_output:
+            stdout = b""
             process.wait()
-            raise e
+        elif stream_output:
+            # Stream the output line by line, so it can be shown as it arrives. We
+            # already know it's going to be shown, so echo it directly, rather than
+            # going through `debug()` for every line.
+            stdout_list: List[bytes] = []
+            if process.stdout:
+                for line in process.stdout:
+                    if capture:
+                        stdout_list.append(line)
+                    echo(line.decode(errors="replace").rstrip("\n"))
+            stdout = b"".join(stdout_list)
+        else:
+            # Nobody will see the output until the command is done, so just read it
+            # all at once.
+            stdout = process.communicate()[0]
+    except KeyboardInterrupt as e:
+        os.kill(process.pid, signal.SIGINT)
+        process.wait()
+        raise e
 
     returncode = process.wait()
-    stdout = b"".join(stdout_list)
     debug(f"Return code: {returncode}")
-    os.chdir(wd)
     return (returncode, stdout)
 
 
+def _run_command_simple(
+    command: List[Union[str, Path]], chdir: Path
+) -> Tuple[int, bytes]:
+    """
+    Run a short command and return its exit code and stdout.
+
+    This is a lighter version of `_run_command_full` for commands whose output we only
+    want to parse, so it doesn't need to be streamed.
+    """
+    args = [str(c) for c in command]
+    if DEBUG:
+        debug(f"Command: cd {shlex.quote(str(chdir))}; {shlex.join(args)}")
+    try:
+        process = subprocess.run(args, cwd=chdir, capture_output=True, check=False)
+    except FileNotFoundError as e:
+        debug(f"Return code: 127\n{e}")
+        return (127, b"")
+
+    debug(f"Return code: {process.returncode}")
+    return (process.returncode, process.stdout)
+
+
 def _run_command(
     command: List[Union[Path, str]],
     chdir: Path,
     environment: Optional[Dict[str, str]] = None,
 ) -> int:
     """Run a command and return its exit code."""
-    return _run_command_full(command, chdir, environment=environment)[0]
+    return _run_command_full(command, chdir, environment=environment, capture=False)[0]
 
 
 def _postproc_command_assuming_exitcode0(status, stdout, errmsg: str) -> int:
@@ -263,6 +558,7 @@ class App:
         cache - The app's cache.
         """
         self.id: str = id
+        self.configuration = configuration
         self.enabled: bool = configuration.get("enabled", True)
         self.url: str = configuration["url"]
         cfn = configuration.get("compose_config", ["docker-compose.yml"])
@@ -271,8 +567,14 @@ class App:
             cfn = [cfn]
         self.compose_config: List[str] = cfn
         self.branch: str = configuration.get("branch", "master")
+        # Whether to only clone/fetch the latest commit, rather than the full history.
+        self.shallow: bool = configuration.get("shallow", True)
         self.paths = paths
         self.cache = cache
+        # The working directories of the running Compose projects, if they have been
+        # fetched for all apps at once. If this is None, or the app's project isn't in
+        # it, `is_running` will ask directly.
+        self.running_project_dirs: Optional[Set[str]] = None
 
         self.environment: Dict[str, str] = _read_var_file(
             filename=configuration.get("environment_file"),
@@ -307,9 +609,36 @@ class App:
             }
         )
 
-        self.configuration_hash = hashlib.sha1(
-            yaml.dump(configuration).encode("utf-8")
-        ).hexdigest()
+    @functools.cached_property
+    def configuration_hash(self) -> str:
+        """
+        Return the hash of the app's configuration stanza.
+
+        This is only computed when it's first needed.
+        """
+        return _hash_dict(self.configuration)
+
+    @functools.cached_property
+    def environment_hash(self) -> str:
+        """Return the hash of the app's environment."""
+        return _hash_dict(self.environment)
+
+    @functools.cached_property
+    def replacements_hash(self) -> str:
+        """Return the hash of the app's replacements."""
+        return _hash_dict(self.replacements)
+
+    def compose_hash(self) -> str:
+        """
+        Return the hash of the (rendered) Compose files and the environment.
+
+        These determine which images the app uses, so if they haven't changed, the
+        images don't need to be pulled again.
+        """
+        h = hashlib.blake2b(self.environment_hash.encode())
+        for cfn in self.compose_config:
+            h.update((self.paths.repo_dir / cfn).read_bytes())
+        return h.hexdigest()
 
     def check_parameter_changes(self) -> bool:
         """
@@ -321,8 +650,8 @@ class App:
 
         We also update `self.cache` with the new values, for later writing.
         """
-        env_hash = _hash_dict(self.environment)
-        replacements_hash = _hash_dict(self.replacements)
+        env_hash = self.environment_hash
+        replacements_hash = self.replacements_hash
         configuration_hash = self.configuration_hash
 
         old_env_hash = self.cache.get("environment_hash", "")
@@ -355,23 +684,31 @@ class App:
         print_output: bool = False,
     ) -> Tuple[int, bytes]:
         return _run_command_full(
-            command, chdir, environment=self.environment, print_output=print_output
+            command,
+            chdir,
+            environment=self.compose_environment,
+            print_output=print_output,
         )
 
+    @functools.cached_property
+    def compose_environment(self) -> Dict[str, str]:
+        """Return the environment to run Compose with, computed only once."""
+        return {**_COMPOSE_ENV, **self.environment}
+
     def ev_run_command_assuming_exitcode_0(
         self, command: List[Union[Path, str]], chdir: Path, errmsg: str
     ) -> int:
         status, stdout = self.ev_run_command_full(command, chdir)
         return _postproc_command_assuming_exitcode0(status, stdout, errmsg)
 
-    @property
+    @functools.cached_property
     def compose_config_command(self) -> List[str]:
         """
         Return a tuple with the command for the filenames of all the Compose files.
 
         The Compose command line accepts any number of YAML config files,
         and this is a convenience method to return them in a format that's easy to
-        use with `subprocess.run`.
+        use with `subprocess.run`. It's only computed once.
         """
         commands = []
         for name in self.compose_config:
@@ -380,6 +717,18 @@ class App:
 
         return commands
 
+    @property
+    def project_dir(self) -> str:
+        """
+        Return the working directory of this app's Compose project.
+
+        Compose uses the directory of the first Compose file, and labels the project's
+        containers with it.
+        """
+        return os.path.dirname(
+            os.path.normpath(self.paths.repo_dir / self.compose_config[0])
+        )
+
     @property
     def repo_dir_exists(self) -> bool:
         """Return whether a repository directory exists for this app."""
@@ -390,65 +739,96 @@ class App:
         Render Harbormaster variables in the Compose file.
 
         This replaces variables like {{ HM_DATA_DIR }} with their value counterparts.
+        Files are only written if rendering changed them, so their modification times
+        are left alone otherwise.
+
+        We store a hash of the replacements and the rendered file in the cache, so if a
+        file is still exactly what we rendered last time, with the same replacements,
+        we don't need to render it again.
         """
+        replacements = {
+            "DATA_DIR": str(self.paths.data_dir),
+            "CACHE_DIR": str(self.paths.cache_dir),
+            "REPO_DIR": str(self.paths.repo_dir),
+        }
+        replacements.update(self.replacements)
+        replacements_hash = _hash_dict(replacements).encode()
+
+        def render_hash(contents: bytes) -> str:
+            return hashlib.blake2b(replacements_hash + contents).hexdigest()
+
+        render_hashes = self.cache.setdefault("render_hashes", {})
         for cfn in self.compose_config:
-            with (self.paths.repo_dir / cfn).open("r+") as cfile:
-                contents = cfile.read()
-
-                replacements = {
-                    "DATA_DIR": str(self.paths.data_dir),
-                    "CACHE_DIR": str(self.paths.cache_dir),
-                    "REPO_DIR": str(self.paths.repo_dir),
-                }
-                replacements.update(self.replacements)
-                contents = _render_template(contents, replacements)
+            path = self.paths.repo_dir / cfn
+            contents = path.read_bytes()
+            if render_hashes.get(str(cfn)) == render_hash(contents):
+                debug(f"{cfn} has already been rendered.")
+                continue
 
-                cfile.truncate(0)
-                cfile.seek(0)
-                cfile.write(contents)
+            rendered = _render_template(contents.decode(), replacements).encode()
+            if rendered != contents:
+                # Write atomically, so Compose never sees a half-written file.
+                _write_atomically(path, rendered)
+            render_hashes[str(cfn)] = render_hash(rendered)
 
     def is_repo(self) -> bool:
-        """Check whether a repository exists and is actually a repository."""
-        if not self.paths.repo_dir.exists():
-            return False
+        """
+        Check whether a repository exists and is actually a repository.
 
-        return (
-            _run_command(
-                ["/usr/bin/env", "git", "rev-parse", "--show-toplevel"],
-                self.paths.repo_dir,
-            )
-            == 0
-        )
+        We only ever clone repositories here, so checking for the `.git` directory is
+        enough, and saves spawning git. Asking git would also be wrong if the working
+        directory was itself inside a repository.
+        """
+        return (self.paths.repo_dir / ".git").is_dir()
 
     def is_running(self) -> bool:
         """Check if the app is running."""
-        stdout = self.ev_run_command_full(
-            [
-                "/usr/bin/env",
-                "docker",
-                "compose",
-                *self.compose_config_command,
-                "ps",
-                "--services",
-                "--filter",
-                "status=running",
-            ],
-            self.paths.repo_dir,
-        )[1].strip()
+        # The snapshot can only tell us which apps are definitely running, as the
+        # containers might have been started from a different path, so ask directly if
+        # the app isn't in it.
+        running = False
+        if self.running_project_dirs is not None:
+            running = self.project_dir in self.running_project_dirs
+        if not running:
+            # Ask Compose, as only it knows the project's name, which can come from the
+            # environment, `.env`, or the Compose file itself.
+            stdout = self.ev_run_command_full(
+                [
+                    _DOCKER,
+                    "compose",
+                    *self.compose_config_command,
+                    "ps",
+                    "--services",
+                    "--filter",
+                    "status=running",
+                ],
+                self.paths.repo_dir,
+            )[1].strip()
+            # If `docker compose ps` returned nothing, nothing is running.
+            running = bool(stdout)
 
-        if stdout:
+        if running:
             debug(f"{self.id} is running.")
         else:
             debug(f"{self.id} is NOT running.")
-        # If `docker ps` returned nothing, nothing is running.
-        return bool(stdout)
+        return running
 
-    def start(self, detach=True):
-        """Start the Docker containers for this app."""
-        status = self.ev_run_command_assuming_exitcode_0(
+    def start(self, detach=True, pull=True):
+        """
+        Start the Docker containers for this app.
+
+        If `pull` is False, images won't be pulled before starting, though Compose
+        will still pull any images that are missing.
+        """
+        if pull:
+            self.pull_images()
+        self.up(detach=detach)
+
+    def pull_images(self):
+        """Pull the Docker images for this app."""
+        self.ev_run_command_assuming_exitcode_0(
             [
-                "/usr/bin/env",
-                "docker",
+                _DOCKER,
                 "compose",
                 *self.compose_config_command,
                 "pull",
@@ -458,9 +838,10 @@ class App:
             "Could not pull the Docker image",
         )
 
+    def up(self, detach=True):
+        """Bring the Docker containers for this app up."""
         command = [
-            "/usr/bin/env",
-            "docker",
+            _DOCKER,
             "compose",
             *self.compose_config_command,
             "up",
@@ -486,8 +867,7 @@ class App:
 
         self.ev_run_command_assuming_exitcode_0(
             [
-                "/usr/bin/env",
-                "docker",
+                _DOCKER,
                 "compose",
                 *self.compose_config_command,
                 "down",
@@ -503,35 +883,49 @@ class App:
 
         Returns whether an update was done.
         """
+        # Submodules aren't cloned, and we only ever fetch a single branch from a
+        # single remote, so git's parallel fetching options (`fetch.parallel`,
+        # `submodule.fetchJobs`) would have nothing to parallelize.
+        command = [_GIT, "clone", "-b", self.branch]
+        if self.shallow:
+            command.extend(["--depth=1", "--single-branch", "--no-tags"])
         _run_command_assuming_exitcode_0(
-            [
-                "/usr/bin/env",
-                "git",
-                "clone",
-                "-b",
-                self.branch,
-                self.url,
-                self.paths.repo_dir,
-            ],
+            [*command, self.url, self.paths.repo_dir],
             self.paths.workdir,
             "Could not clone repository.",
         )
+        self.cache["origin_url"] = self.url
+        self.cache["fetched_at"] = time.time()
 
         return True
 
-    def pull(self) -> bool:
+    def pull(self, min_poll_interval: int = 0) -> bool:
         """
         Pull a repository.
 
+        If the repository was fetched less than `min_poll_interval` seconds ago, and the
+        app's configuration and replacements haven't changed since, it isn't fetched
+        again. Changed replacements need a reset, as the Compose files can only be
+        rendered from their pristine versions.
+
         Return a boolean indicating whether an update was done.
         """
         if not self.enabled:
             debug("App isn't enabled, will not pull.")
             return False
 
+        if (
+            time.time() - self.cache.get("fetched_at", 0) < min_poll_interval
+            and self.cache.get("configuration_hash") == self.configuration_hash
+            and self.cache.get("replacements_hash") == self.replacements_hash
+        ):
+            debug("The repository was fetched recently, will not pull.")
+            return False
+
         # Note the old revision for change detection.
         old_rev = self.get_current_hash()
         self.pull_upstream()
+        self.cache["fetched_at"] = time.time()
         new_rev = self.get_current_hash()
 
         debug(f"Old rev is {old_rev}, new rev is {new_rev}.")
@@ -544,14 +938,47 @@ class App:
 
     def get_current_hash(self) -> str:
         """Return the git repository's current commit SHA."""
+        try:
+            return _read_git_head(self.paths.repo_dir)
+        except Exception as e:
+            debug(f"Could not read HEAD from disk ({e}), asking git.")
+
         return (
-            _run_command_full(
-                ["/usr/bin/env", "git", "rev-parse", "HEAD"], self.paths.repo_dir
-            )[1]
+            _run_command_simple([_GIT, "rev-parse", "HEAD"], self.paths.repo_dir)[1]
             .decode()
             .strip()
         )
 
+    def get_remote_hash(self) -> Optional[str]:
+        """
+        Return the commit SHA the branch points to on the remote, or None on error.
+
+        This only asks the remote for the branch's SHA, which is much cheaper than a
+        fetch, as even a fetch that's already up to date makes the remote go through
+        its pack negotiation.
+        """
+        ref = f"refs/heads/{self.branch}"
+        status, stdout = _run_command_simple(
+            [_GIT, "ls-remote", "origin", ref], self.paths.repo_dir
+        )
+        if status != 0:
+            return None
+
+        for line in stdout.decode().splitlines():
+            sha, _, name = line.partition("\t")
+            if name == ref:
+                return sha
+        return None
+
+    def get_fetched_hash(self) -> Optional[str]:
+        """Return the commit SHA we last fetched for the branch, or None if unknown."""
+        try:
+            return _read_git_ref(
+                self.paths.repo_dir, f"refs/remotes/origin/{self.branch}"
+            )
+        except Exception:
+            return None
+
     def pull_upstream(self) -> None:
         """
         Pull the upstream changes, making sure they're applied locally.
@@ -561,33 +988,67 @@ class App:
         local repository looks exactly like the remote and branch that was specified, no
         matter what.
         """
-        _run_command_assuming_exitcode_0(
-            ["/usr/bin/env", "git", "remote", "set-url", "origin", self.url],
-            self.paths.repo_dir,
-            "Could not set origin.",
-        )
+        # The URL rarely changes, so only set it if it's different from the one we set
+        # last time.
+        if self.cache.get("origin_url") != self.url:
+            _run_command_assuming_exitcode_0(
+                [_GIT, "remote", "set-url", "origin", self.url],
+                self.paths.repo_dir,
+                "Could not set origin.",
+            )
+            self.cache["origin_url"] = self.url
 
-        _run_command_assuming_exitcode_0(
-            ["/usr/bin/env", "git", "fetch", "--force", "origin", self.branch],
-            self.paths.repo_dir,
-            "Could not fetch from origin.",
+        # A shallow clone stays shallow until it's explicitly unshallowed, so we need to
+        # do that if the app has stopped being shallow since it was cloned.
+        unshallow = (
+            not self.shallow and (self.paths.repo_dir / ".git" / "shallow").exists()
         )
 
+        remote_hash = self.get_remote_hash()
+        if (
+            not unshallow
+            and remote_hash is not None
+            and remote_hash == self.get_fetched_hash()
+        ):
+            # We already have the latest commit, so there's nothing to fetch.
+            debug("The remote branch hasn't changed, will not fetch.")
+        else:
+            # Fetch into the remote-tracking branch explicitly, as single-branch
+            # clones won't update it by themselves if the branch has changed.
+            command = [_GIT, "fetch", "--force"]
+            if self.shallow:
+                command.extend(["--depth=1", "--no-tags"])
+            else:
+                # Shallow clones are made with `--no-tags`, which git remembers, so ask
+                # for the tags explicitly.
+                command.append("--tags")
+                if unshallow:
+                    command.append("--unshallow")
+            _run_command_assuming_exitcode_0(
+                [
+                    *command,
+                    "origin",
+                    f"+refs/heads/{self.branch}:refs/remotes/origin/{self.branch}",
+                ],
+                self.paths.repo_dir,
+                "Could not fetch from origin.",
+            )
+
         _run_command_assuming_exitcode_0(
-            ["/usr/bin/env", "git", "reset", "--hard", f"origin/{self.branch}"],
+            [_GIT, "reset", "--hard", f"origin/{self.branch}"],
             self.paths.repo_dir,
             "Could not reset local repository to the origin.",
         )
 
-    def clone_or_pull(self) -> bool:
+    def clone_or_pull(self, min_poll_interval: int = 0) -> bool:
         """Pull a repository, or clone it if it hasn't been initialized yet."""
         for _ in range(MAX_GIT_NETWORK_ATTEMPTS):
             try:
                 if self.is_repo():
-                    click.echo(f"Pulling {self.url} to {self.paths.repo_dir}...")
-                    updated = self.pull()
+                    echo(f"Pulling {self.url} to {self.paths.repo_dir}...")
+                    updated = self.pull(min_poll_interval=min_poll_interval)
                 else:
-                    click.echo(f"Cloning {self.url} to {self.paths.repo_dir}...")
+                    echo(f"Cloning {self.url} to {self.paths.repo_dir}...")
                     updated = self.clone()
 
                 self._render_config_vars()
@@ -595,8 +1056,8 @@ class App:
             except Exception as e:
                 last_exception = e
 
-            click.echo(f"Error with git clone/pull request: {last_exception}")
-            click.echo(f"Will retry after {RETRY_WAIT_SECONDS} seconds.")
+            echo(f"Error with git clone/pull request: {last_exception}")
+            echo(f"Will retry after {RETRY_WAIT_SECONDS} seconds.")
             time.sleep(RETRY_WAIT_SECONDS)
         raise last_exception
 
@@ -613,11 +1074,15 @@ class Configuration:
         cache = {}
         try:
             if paths.cache_file.exists():
-                cache = json.loads(paths.cache_file.read_text())
+                cache = json.loads(paths.cache_file.read_bytes())
         except Exception as e:
             click.echo(f"Error while reading cache: {e}")
 
-        configuration = yaml.safe_load(open(config)) or {}
+        if cache.get("version") != CACHE_VERSION:
+            # Hashes from other cache versions aren't comparable to ours, discard them.
+            cache = {}
+
+        configuration = _load_config(config, paths.config_cache_file)
         cfg = configuration.get("config", {})
         instance = cls(
             prune=cfg.get("prune", False),
@@ -635,88 +1100,221 @@ class Configuration:
         return instance
 
 
-def process_config(configuration: Configuration, force_restart: bool = False) -> bool:
+def _process_app(app: App, force_restart: bool, min_poll_interval: int) -> bool:
+    """
+    Update, stop and start a single app as needed.
+
+    Returns whether the app was processed successfully.
+    """
+    debug("-" * 100)
+    echo(f"Updating {app.id} ({app.branch})...")
+    try:
+        if app.enabled:
+            # Always fetch if we've been asked to restart everything.
+            updated_repo = app.clone_or_pull(
+                min_poll_interval=0 if force_restart else min_poll_interval
+            )
+            if updated_repo:
+                echo(f"{app.id}: Repo was updated.")
+        else:
+            debug(f"{app.id} is disabled, will not pull.")
+            updated_repo = False
+
+        parameters_changed = app.check_parameter_changes()
+
+        needs_restart = updated_repo or parameters_changed or force_restart
+
+        # The app needs to be restarted, or is not enabled, so stop it.
+        if app.repo_dir_exists and (needs_restart or not app.enabled):
+            echo(f"{app.id}: Stopping...")
+            app.stop()
+            stopped = True
+        else:
+            stopped = False
+
+        # The app is not running and it should be, so start it.
+        if app.enabled and (stopped or not app.is_running()):
+            # Only pull the images if the repo was updated or the images might have
+            # changed, otherwise the app just needs to be brought back up.
+            compose_hash = app.compose_hash()
+            pull = (
+                updated_repo
+                or force_restart
+                or compose_hash != app.cache.get("compose_hash")
+            )
+            app.start(pull=pull)
+            app.cache["compose_hash"] = compose_hash
+            echo(f"{app.id}: Starting...")
+        else:
+            echo(f"{app.id}: App does not need to be started.")
+        success = True
+    except Exception as e:
+        echo(f"{app.id}: Error while processing: {e}")
+        success = False
+    echo("")
+    return success
+
+
+def process_config(
+    configuration: Configuration,
+    force_restart: bool = False,
+    jobs: int = MAX_WORKERS,
+    min_poll_interval: int = 0,
+) -> bool:
     """
     Process a given configuration file.
 
     This is the main function that loads the configuration the file and starts/stops
-    apps as needed.
+    apps as needed. Up to `jobs` apps are processed at the same time, and apps whose
+    repositories were fetched less than `min_poll_interval` seconds ago aren't fetched
+    again.
     """
-    successes = []
-    cache = {"version": 1}
-    for app in configuration.apps:
-        debug("-" * 100)
-        click.echo(f"Updating {app.id} ({app.branch})...")
-        try:
-            if app.enabled:
-                updated_repo = app.clone_or_pull()
-                if updated_repo:
-                    click.echo(f"{app.id}: Repo was updated.")
-            else:
-                debug(f"{app.id} is disabled, will not pull.")
-                updated_repo = False
-
-            parameters_changed = app.check_parameter_changes()
-
-            # The app needs to be restarted, or is not enabled, so stop it.
-            if app.repo_dir_exists and (
-                updated_repo or parameters_changed or force_restart or not app.enabled
-            ):
-                click.echo(f"{app.id}: Stopping...")
-                app.stop()
-                stopped = True
-            else:
-                stopped = False
+    apps = configuration.apps
+
+    # Get the running state of all the apps with a single call.
+    running_project_dirs = _get_running_project_dirs()
+    for app in apps:
+        app.running_project_dirs = running_project_dirs
+
+    # Apps are independent of each other, and processing them is mostly waiting on
+    # the network and the Docker daemon, so process them in parallel.
+    workers = max(1, min(jobs, len(apps)))
+
+    def process(app: App) -> bool:
+        # Print each app's output in one go, so the output of apps being processed at
+        # the same time doesn't get mixed up.
+        with _buffered_output(enabled=workers > 1):
+            return _process_app(app, force_restart, min_poll_interval)
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        successes = list(ex.map(process, apps))
+
+    # Write the cache, but only for the apps that were processed successfully.
+    cache: Dict[str, Any] = {"version": CACHE_VERSION}
+    for app, success in zip(apps, successes):
+        if success:
+            cache[app.id] = app.cache
 
-            # The app is not running and it should be, so start it.
-            if app.enabled and (stopped or not app.is_running()):
-                app.start()
-                click.echo(f"{app.id}: Starting...")
-            else:
-                click.echo(f"{app.id}: App does not need to be started.")
+    # Write the cache atomically, so an interrupted run can't leave it half-written.
+    _write_atomically(
+        configuration.paths.cache_file, json.dumps(cache, separators=(",", ":"))
+    )
 
-            cache[app.id] = app.cache
+    return all(successes)
 
-            successes.append(True)
-        except Exception as e:
-            click.echo(f"{app.id}: Error while processing: {e}")
-            successes.append(False)
-        click.echo("")
 
-    # Write the cache.
-    cache_file = configuration.paths.cache_file
-    cache_file.write_text(json.dumps(cache))
+def _subdir_names(path: Path) -> Set[str]:
+    """
+    Return the names of all the directories in a directory.
 
-    return all(successes)
+    `os.scandir` gets the entry types along with the names, so this doesn't need to
+    stat each entry separately.
+    """
+    with os.scandir(path) as entries:
+        return {entry.name for entry in entries if entry.is_dir()}
 
 
-def archive_stale_data(repos: List[App], paths: Paths):
-    app_names = set(repo.id for repo in repos)
+def _remove_tree(path: Path) -> None:
+    """
+    Delete a directory tree, reporting any files that could not be deleted.
 
-    current_repos = set(x.name for x in paths.repos_dir.iterdir() if x.is_dir())
-    current_data = set(x.name for x in paths.data_dir.iterdir() if x.is_dir())
-    current_caches = set(x.name for x in paths.caches_dir.iterdir() if x.is_dir())
+    This runs in the background, so rather than raising on the first error (and
+    leaving the rest of the tree behind), keep deleting and report the failures at the
+    end, once for the whole tree. These are usually files that containers created as
+    another user.
+    """
+    failures: List[str] = []
 
-    for stale_repo in current_repos - app_names:
-        path = paths.repos_dir / stale_repo
-        click.echo(
-            f"The repo for {stale_repo} is stale, stopping any running containers..."
+    def onerror(function, failed_path, exc_info):
+        failures.append(f"{failed_path}: {exc_info[1]}")
+
+    shutil.rmtree(path, onerror=onerror)
+    if failures:
+        echo(
+            f"Could not delete {len(failures)} item(s) in {path}, the first error "
+            f"was:\n{failures[0]}"
         )
-        _kill_orphan_containers(stale_repo)
-        click.echo(f"Removing {path}...")
-        shutil.rmtree(path)
 
+
+def _empty_trash(trash_dir: Path, names: Optional[Set[str]] = None) -> None:
+    """
+    Delete the given directories (or all of them) in the trash in the background.
+
+    The threads aren't daemon threads, so we'll wait for them to finish before exiting.
+    """
+    if names is None:
+        names = _subdir_names(trash_dir) if trash_dir.exists() else set()
+
+    for name in names:
+        threading.Thread(target=_remove_tree, args=(trash_dir / name,)).start()
+
+
+def _delete_in_background(path: Path, trash_dir: Path) -> None:
+    """
+    Move a directory into the trash and delete it in a background thread.
+
+    Renaming is instant, whereas deleting a large repository can take a while, so
+    this gets the directory out of the way without waiting for it to be deleted.
+    """
+    trash_dir.mkdir(exist_ok=True)
+    trash_path = trash_dir / f"{path.name}-{uuid.uuid4().hex}"
+    try:
+        path.rename(trash_path)
+    except OSError:
+        # The directory might be on a different filesystem than the trash, where
+        # renaming won't work, so just delete it here.
+        _remove_tree(path)
+        return
+    _empty_trash(trash_dir, names={trash_path.name})
+
+
+def archive_stale_data(repos: List[App], paths: Paths, jobs: int = MAX_WORKERS):
+    app_names = set(repo.id for repo in repos)
+
+    # Delete anything a previous run didn't get to finish deleting.
+    _empty_trash(paths.trash_dir)
+
+    current_repos = _subdir_names(paths.repos_dir)
+    current_data = _subdir_names(paths.data_dir)
+    current_caches = _subdir_names(paths.caches_dir)
+
+    # Stopping containers is mostly waiting on the Docker daemon, so do it for all the
+    # stale repos in parallel.
+    stale_repos = sorted(current_repos - app_names)
+    workers = max(1, min(jobs, len(stale_repos)))
+
+    def remove_stale_repo(stale_repo: str) -> None:
+        # Keep each repo's messages together, as the repos are removed in parallel.
+        with _buffered_output(enabled=workers > 1):
+            path = paths.repos_dir / stale_repo
+            echo(
+                f"The repo for {stale_repo} is stale, stopping any running containers..."
+            )
+            _kill_orphan_containers(stale_repo)
+            echo(f"Removing {path}...")
+            _delete_in_background(path, paths.trash_dir)
+
+    if stale_repos:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(remove_stale_repo, stale_repos))
+
+    # Use the same timestamp for all the data archived in this run.
+    timestamp = strftime("%Y-%m-%d_%H-%M-%S")
     for stale_data in current_data - app_names:
         path = paths.data_dir / stale_data
         click.echo(f"The data for {stale_data} is stale, archiving {path}...")
-        path.rename(
-            paths.archives_dir / f"{stale_data}-{strftime('%Y-%m-%d_%H-%M-%S')}"
-        )
+        archive_path = paths.archives_dir / f"{stale_data}-{timestamp}"
+        try:
+            path.rename(archive_path)
+        except OSError:
+            # The archives directory might be on a different filesystem, where
+            # renaming won't work.
+            shutil.move(str(path), str(archive_path))
 
     for stale_caches in current_caches - app_names:
         path = paths.caches_dir / stale_caches
         click.echo(f"The cache for {stale_caches} is stale, deleting {path}...")
-        shutil.rmtree(path)
+        _delete_in_background(path, paths.trash_dir)
 
 
 @click.group(cls=HelpColorsGroup, help_headers_color="blue", help_options_color="green")
@@ -760,7 +1358,28 @@ def cli(debug: bool):
     is_flag=True,
     help="Restart all apps even if their repositories have not changed.",
 )
-def run(config: Path, working_dir: Path, force_restart: bool):
+@click.option(
+    "-j",
+    "--jobs",
+    default=MAX_WORKERS,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="The maximum number of apps to process (or remove) at the same time.",
+)
+@click.option(
+    "--min-poll-interval",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Don't fetch repositories that were fetched less than this many seconds ago.",
+)
+def run(
+    config: Path,
+    working_dir: Path,
+    force_restart: bool,
+    jobs: int,
+    min_poll_interval: int,
+):
     workdir = working_dir
     paths = Paths.for_workdir(workdir, config_dir=config.absolute().parent)
     paths.create_directories()
@@ -770,15 +1389,19 @@ def run(config: Path, working_dir: Path, force_restart: bool):
         click.echo("No apps specified, nothing to do.")
         sys.exit(0)
 
-    archive_stale_data(configuration.apps, paths)
-    success = process_config(configuration, force_restart=force_restart)
+    archive_stale_data(configuration.apps, paths, jobs=jobs)
+    success = process_config(
+        configuration,
+        force_restart=force_restart,
+        jobs=jobs,
+        min_poll_interval=min_poll_interval,
+    )
 
     if configuration.prune:
         click.echo("Pruning all unused images...")
         _run_command(
             [
-                "/usr/bin/env",
-                "docker",
+                _DOCKER,
                 "system",
                 "prune",
                 "--all",
@@ -870,8 +1493,9 @@ def test(
     # We don't have a config dir for this, so just set the root.
     paths = Paths.for_workdir(working_dir, config_dir=Path("/"))
     paths.create_directories()
-    app_paths = AppPaths.from_paths(paths, app_id)
-    app_paths.repo_dir = Path(".").absolute()
+    app_paths = attr.evolve(
+        AppPaths.from_paths(paths, app_id), repo_dir=Path(".").absolute()
+    )
 
     repo_config = {
         "enabled": True,
@@ -930,7 +1554,7 @@ def test(
         "config file:\n",
         fg="green",
     )
-    click.echo(yaml.dump({"apps": {"myapp": repo_config}}))
+    click.echo(_dump_yaml({"apps": {"myapp": repo_config}}))
 
 
 if __name__ == "__main__":
@@ -10,13 +10,22 @@ REPOS_DIR_NAME = "repos"
 CACHES_DIR_NAME = "caches"
 DATA_DIR_NAME = "data"
 
+# Stale directories are moved here and deleted in the background, so deleting them
+# doesn't hold up the run.
+TRASH_DIR_NAME = ".trash"
+
 # We use a single cache file in the root of the base directory. It's a JSON file
 # containing hashes of various user-provided files, and we use it to check if the files
 # have changed since the previous run.
 CACHE_FILE_NAME = ".harbormaster.cache"
 
+# The parsed configuration file is stored as JSON next to the cache file, keyed by the
+# configuration file's path, modification time and size, so we don't have to parse the
+# YAML again if it hasn't changed.
+CONFIG_CACHE_FILE_NAME = ".harbormaster.config.cache"
+
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True, frozen=True)
 class Paths:
     """
     The relevant working paths for this specific configuration run.
@@ -32,7 +41,9 @@ class Paths:
     repos_dir: Path
     caches_dir: Path
     data_dir: Path
+    trash_dir: Path
     cache_file: Path
+    config_cache_file: Path
 
     def create_directories(self):
         """Create all the necessary directories."""
@@ -42,7 +53,10 @@ class Paths:
             self.caches_dir,
             self.data_dir,
         ):
-            directory.mkdir(exist_ok=True)
+            # The directories almost always exist already, so only try to create the
+            # ones that don't.
+            if not directory.is_dir():
+                directory.mkdir(parents=True, exist_ok=True)
 
     @classmethod
     def for_workdir(cls, workdir: Path, config_dir: Path):
@@ -54,11 +68,13 @@ class Paths:
             archives_dir=(workdir / ARCHIVES_DIR_NAME).absolute(),
             repos_dir=(workdir / REPOS_DIR_NAME).absolute(),
             caches_dir=(workdir / CACHES_DIR_NAME).absolute(),
+            trash_dir=(workdir / TRASH_DIR_NAME).absolute(),
             cache_file=(workdir / CACHE_FILE_NAME).absolute(),
+            config_cache_file=(workdir / CONFIG_CACHE_FILE_NAME).absolute(),
         )
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True, frozen=True)
 class AppPaths:
     workdir: Path
     repo_dir: Path
@@ -87,10 +103,10 @@ def options_to_dict(options: Tuple[str]) -> Dict[str, str]:
     """
     options_dict = {}
     for option in options:
-        if "=" not in option:
+        key, equals, value = option.partition("=")
+        if not equals:
             sys.exit(
                 "Invalid environment or replacement parameter specified, (missing `=`)."
             )
-        key, value = option.split("=", 1)
         options_dict[key] = value
     return options_dict
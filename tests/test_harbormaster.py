@@ -2,6 +2,7 @@ import random
 from pathlib import Path
 from typing import Dict
 
+import git
 import pytest
 from utils import Repository
 from utils import run_harbormaster
@@ -15,10 +16,16 @@ cli.MAX_GIT_NETWORK_ATTEMPTS = 1
 cli.DEBUG = True
 
 
-@pytest.fixture()
-def repos(tmp_path):
-    """Set up the required repositories for the tests."""
-    repos = {}
+@pytest.fixture(scope="session")
+def repo_templates(tmp_path_factory):
+    """
+    Set up the app repositories once, for all the tests.
+
+    Creating repositories and committing to them is the slowest part of the tests, so
+    we do it once and give each test its own copy (see `repos`).
+    """
+    root_dir = tmp_path_factory.mktemp("templates")
+    templates = {}
 
     def dockerfile():
         # We need to add a random number in the Dockerfile, otherwise git produces the
@@ -41,7 +48,7 @@ services:
         )
 
     # Create the app repo and add an app.
-    repo = Repository("apps", tmp_path)
+    repo = Repository("apps", root_dir)
     repo.add_files(dockerfile())
     # Add app1.
     repo.checkout("app1")
@@ -49,10 +56,10 @@ services:
     # Add app2.
     repo.checkout("app2")
     repo.add_files(dockerfile())
-    repos["apps"] = repo
+    templates["apps"] = repo
 
     # Create another app repo and add an app.
-    repo = Repository("apps2", tmp_path)
+    repo = Repository("apps2", root_dir)
     repo.add_files(dockerfile())
     # Add app1.
     repo.checkout("app1")
@@ -60,7 +67,16 @@ services:
     # Add app2.
     repo.checkout("app2")
     repo.add_files(dockerfile())
-    repos["apps2"] = repo
+    templates["apps2"] = repo
+
+    return templates
+
+
+@pytest.fixture()
+def repos(tmp_path, repo_templates):
+    """Set up the required repositories for the tests."""
+    # Tests commit to the app repos, so each one gets its own copy.
+    repos = {name: template.copy(tmp_path) for name, template in repo_templates.items()}
 
     # Create the Harbormaster config repo.
     repos["config"] = Repository("config", tmp_path)
@@ -87,36 +103,26 @@ def test_one_app(tmp_path: Path, repos: Dict[str, Repository]):
     assert result.exit_code == 0
     assert result.output
     assert output["commands"] == [
-        "/usr/bin/env docker compose -f docker-compose.yml ps --services --filter status=running",
-        "/usr/bin/env docker compose -f docker-compose.yml pull --ignore-buildable",
-        "/usr/bin/env docker compose -f docker-compose.yml up --remove-orphans --build --detach",
+        'docker ps --filter status=running --format {{.Label "com.docker.compose.project.working_dir"}}',
+        "docker compose -f docker-compose.yml ps --services --filter status=running",
+        "docker compose -f docker-compose.yml pull --ignore-buildable",
+        "docker compose -f docker-compose.yml up --remove-orphans --build --detach",
     ]
 
 
 def test_env_changes(tmp_path: Path, repos: Dict[str, Repository]):
     """Check a single-app scenario."""
-    repos["config"].add_files(
-        (
-            (
-                "harbormaster.yml",
-                f"""
----
-apps:
-  myapp:
-    url: {repos['apps'].path}
-""",
-            ),
-        ),
-    )
+    # The repos fixture has already committed the single-app configuration.
     result, output = run_harbormaster(tmp_path, repos)
 
     assert result.exit_code == 0
     assert result.output
     assert output["restarted_apps"] == {"myapp"}
     assert output["commands"] == [
-        "/usr/bin/env docker compose -f docker-compose.yml ps --services --filter status=running",
-        "/usr/bin/env docker compose -f docker-compose.yml pull --ignore-buildable",
-        "/usr/bin/env docker compose -f docker-compose.yml up --remove-orphans --build --detach",
+        'docker ps --filter status=running --format {{.Label "com.docker.compose.project.working_dir"}}',
+        "docker compose -f docker-compose.yml ps --services --filter status=running",
+        "docker compose -f docker-compose.yml pull --ignore-buildable",
+        "docker compose -f docker-compose.yml up --remove-orphans --build --detach",
     ]
 
     repos["config"].add_files(
@@ -139,9 +145,10 @@ apps:
     assert result.output
     assert output["restarted_apps"] == {"myapp"}
     assert output["commands"] == [
-        "/usr/bin/env docker compose -f docker-compose.yml ps --services --filter status=running",
-        "/usr/bin/env docker compose -f docker-compose.yml pull --ignore-buildable",
-        "/usr/bin/env docker compose -f docker-compose.yml up --remove-orphans --build --detach",
+        'docker ps --filter status=running --format {{.Label "com.docker.compose.project.working_dir"}}',
+        "docker compose -f docker-compose.yml ps --services --filter status=running",
+        "docker compose -f docker-compose.yml pull --ignore-buildable",
+        "docker compose -f docker-compose.yml up --remove-orphans --build --detach",
     ]
 
     result, output = run_harbormaster(tmp_path, repos)
@@ -237,6 +244,49 @@ apps:
     assert result.exit_code == 0
     assert result.output
     assert output["restarted_apps"] == {"app2"}
+    # app1's branch didn't change, so it shouldn't have been fetched.
+    assert "The remote branch hasn't changed, will not fetch." in result.output
+
+
+def test_min_poll_interval(tmp_path: Path, repos: Dict[str, Repository]):
+    """Check that recently fetched repos aren't fetched again."""
+    repos["config"].add_files(
+        (
+            (
+                "harbormaster.yml",
+                f"""
+---
+apps:
+  app1:
+    url: {repos['apps'].path}
+    branch: app1
+""",
+            ),
+        ),
+    )
+
+    args = ["--min-poll-interval", "3600"]
+    result, output = run_harbormaster(tmp_path, repos, args)
+
+    assert result.exit_code == 0
+    assert output["restarted_apps"] == {"app1"}
+
+    repos["apps"].checkout("app1")
+    repos["apps"].add_files(
+        (("test", "Whatever"),),
+    )
+
+    # The repo was fetched less than an hour ago, so the change shouldn't be seen.
+    result, output = run_harbormaster(tmp_path, repos, args)
+
+    assert result.exit_code == 0
+    assert output["restarted_apps"] == set()
+
+    # Without the interval, the repo should be fetched and the app restarted.
+    result, output = run_harbormaster(tmp_path, repos)
+
+    assert result.exit_code == 0
+    assert output["restarted_apps"] == {"app1"}
 
 
 def test_changing_remotes(tmp_path: Path, repos: Dict[str, Repository]):
@@ -398,3 +448,94 @@ apps:
     assert result.exit_code == 0
     assert result.output
     assert output["restarted_apps"] == {"app1"}
+    # The Compose file hasn't changed, so the images shouldn't be pulled again.
+    assert (
+        "docker compose -f docker-compose.yml pull --ignore-buildable"
+        not in output["commands"]
+    )
+
+
+def test_compose_project_dirs(tmp_path: Path, repos: Dict[str, Repository]):
+    """Check apps whose Compose file is in a subdirectory and names the project."""
+    repos["apps"].checkout("master")
+    repos["apps"].add_files(
+        (("apps/app.yml", "---\nname: custom\nservices:\n  web:\n    image: app\n"),)
+    )
+    repos["config"].add_files(
+        (
+            (
+                "harbormaster.yml",
+                f"""
+---
+apps:
+  app1:
+    url: {repos['apps'].path}
+    compose_config: apps/app.yml
+""",
+            ),
+        ),
+    )
+    ps_command = "docker compose -f apps/app.yml ps --services --filter status=running"
+    up_command = "docker compose -f apps/app.yml up --remove-orphans --build --detach"
+
+    # Nothing is running, so Compose should be asked about the app before starting it.
+    result, output = run_harbormaster(tmp_path, repos)
+
+    assert result.exit_code == 0
+    assert ps_command in output["commands"]
+    assert up_command in output["commands"]
+
+    repos["config"].add_files(
+        (
+            (
+                "harbormaster.yml",
+                f"""
+---
+apps:
+  app1:
+    enabled: false
+    url: {repos['apps'].path}
+    compose_config: apps/app.yml
+""",
+            ),
+        ),
+    )
+
+    # The app's containers are running from its Compose file's directory, so it should
+    # be stopped without asking Compose.
+    project_dir = tmp_path / "working_dir" / "repos" / "app1" / "apps"
+    snapshot = 'docker ps --filter status=running --format {{.Label "com.docker.compose.project.working_dir"}}'
+    result, output = run_harbormaster(
+        tmp_path, repos, docker_outputs={snapshot: f"{project_dir}\n".encode()}
+    )
+
+    assert result.exit_code == 0
+    assert ps_command not in output["commands"]
+    assert "docker compose -f apps/app.yml down --remove-orphans" in output["commands"]
+
+
+def test_unshallowing(tmp_path: Path, repos: Dict[str, Repository]):
+    """Check that shallow clones get their history back when shallow is disabled."""
+    # Local paths are always cloned in full, so use a file:// URL.
+    config = f"""
+---
+apps:
+  app1:
+    url: file://{repos["apps"].path}
+    branch: app1
+"""
+    repos["config"].add_files((("harbormaster.yml", config),))
+    result, output = run_harbormaster(tmp_path, repos)
+
+    assert result.exit_code == 0
+    repo = git.Repo(tmp_path / "working_dir" / "repos" / "app1")
+    assert repo.git.rev_list("--count", "HEAD") == "1"
+
+    repos["config"].add_files((("harbormaster.yml", config + "    shallow: false\n"),))
+    result, output = run_harbormaster(tmp_path, repos)
+
+    assert result.exit_code == 0
+    assert repo.git.rev_list("--count", "HEAD") == "2"
+    assert not (
+        tmp_path / "working_dir" / "repos" / "app1" / ".git" / "shallow"
+    ).exists()
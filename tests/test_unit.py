@@ -1,9 +1,15 @@
+import json
+import threading
 from pathlib import Path
+from unittest.mock import patch
 
+import git
 import pytest
-import yaml
 
 from docker_harbormaster import cli
+from docker_harbormaster.utils import AppPaths
+from docker_harbormaster.utils import options_to_dict
+from docker_harbormaster.utils import Paths
 
 cli.DEBUG = True
 
@@ -17,10 +23,25 @@ def test_template():
         ("""{{ HM_FOO }} {{ BAR }}""", "3 {{ BAR }}"),
         ("""{{ HM_BAR }}, {{ HM_BAZ:a } }}""", "4, HM_INVALID_DEFAULT_VALUE"),
         ("""{{ HM_BAR }}, {{ HM_BAZ:"hello" }}""", "4, hello"),
+        ("""{{ HM_FOO:5 }}, {{HM_BAR}}, {{ HM_BAZ:"a" }}""", "3, 4, a"),
+        ("""{{ FOO }}, no variables here""", "{{ FOO }}, no variables here"),
+        ("""{{ HM_BAZ : "a" }}, {{ HM_FOO :"b"}}, {{HM_BAZ: 5}}""", "a, 3, 5"),
     ]
     for template, result in templates:
         assert cli._render_template(template, replacements) == result
 
+    # All replacements should be applied, however many there are.
+    replacements = {f"VAR{i}": i for i in range(100)}
+    template = " ".join(f"{{{{ HM_VAR{i} }}}}" for i in reversed(range(100)))
+    assert cli._render_template(template, replacements) == " ".join(
+        str(i) for i in reversed(range(100))
+    )
+
+    # Repeated defaults should only be parsed once.
+    cli._parse_default.cache_clear()
+    assert cli._render_template("{{ HM_A:80 }} {{ HM_B:80 }}", {}) == "80 80"
+    assert cli._parse_default.cache_info().misses == 1
+
 
 def test_var_reading(tmpdir):
     tmpdir = Path(tmpdir)
@@ -29,7 +50,7 @@ def test_var_reading(tmpdir):
 
     d = {"FOO": "bar", "BAZ": "3"}
     with open(filename, "w") as outfile:
-        outfile.write(yaml.safe_dump(d))
+        outfile.write(cli._dump_yaml(d))
     assert cli._read_var_file(filename, tmpdir, "id") == d
 
     # Dump the file improperly, with ints as ints instead of strings.
@@ -54,3 +75,270 @@ def test_var_reading(tmpdir):
     with open(filename, "w") as outfile:
         outfile.write("\n".join(f"{key}={value}" for key, value in d.items()))
     assert cli._read_var_file(filename, tmpdir, "id") == d
+
+    with open(filename, "w", newline="") as outfile:
+        outfile.write("FOO=bar=baz\r\n\r\nBAZ=\r\n")
+    assert cli._read_var_file(filename, tmpdir, "id") == {"FOO": "bar=baz", "BAZ": ""}
+
+    with open(filename, "w") as outfile:
+        outfile.write("FOO=bar\nBAZ\n")
+    with pytest.raises(SystemExit):
+        cli._read_var_file(filename, tmpdir, "id")
+
+
+def test_config_cache(tmpdir):
+    tmpdir = Path(tmpdir)
+
+    config = tmpdir / "harbormaster.yml"
+    cache_file = tmpdir / "config.cache"
+
+    config.write_text("apps:\n  myapp:\n    url: https://example.com/repo.git\n")
+    expected = {"apps": {"myapp": {"url": "https://example.com/repo.git"}}}
+    assert cli._load_config(config, cache_file) == expected
+    assert cache_file.exists()
+    assert cli._load_config(config, cache_file) == expected
+
+    # Changing the file should invalidate the cache.
+    config.write_text("apps: {}\n")
+    assert cli._load_config(config, cache_file) == {"apps": {}}
+
+    # Dates can't be represented in JSON, so they shouldn't be cached.
+    cache_file.unlink()
+    config.write_text("apps: {}\ndate: 2021-01-01\n")
+    assert "date" in cli._load_config(config, cache_file)
+    assert not cache_file.exists()
+
+    # World-writable caches shouldn't be trusted.
+    config.write_text("apps: {}\n")
+    cli._load_config(config, cache_file)
+    cached = json.loads(cache_file.read_text())
+    cache_file.write_text(json.dumps({"key": cached["key"], "data": {"apps": 1}}))
+    cache_file.chmod(0o666)
+    assert cli._load_config(config, cache_file) == {"apps": {}}
+
+
+def test_read_git_head(tmpdir):
+    tmpdir = Path(tmpdir)
+
+    repo = git.Repo.init(tmpdir)
+    (tmpdir / "file").write_text("hello")
+    repo.index.add("file")
+    commit = repo.index.commit("Commit")
+    assert cli._read_git_head(tmpdir) == commit.hexsha
+
+    # The ref should also be found when it's packed.
+    repo.git.pack_refs("--all")
+    assert cli._read_git_head(tmpdir) == commit.hexsha
+
+    # A detached HEAD contains the SHA directly.
+    repo.git.checkout(commit.hexsha)
+    assert cli._read_git_head(tmpdir) == commit.hexsha
+
+
+def test_run_command_cwd(tmpdir):
+    tmpdir = Path(tmpdir)
+
+    cwd = Path.cwd()
+    returncode, stdout = cli._run_command_full(["pwd"], tmpdir)
+    assert returncode == 0
+    assert Path(stdout.decode().strip()).resolve() == tmpdir.resolve()
+    # Commands shouldn't change our own working directory.
+    assert Path.cwd() == cwd
+
+
+def test_run_command_capture(tmpdir, monkeypatch):
+    monkeypatch.setattr(cli, "DEBUG", False)
+    tmpdir = Path(tmpdir)
+
+    assert cli._run_command_full(["echo", "hi"], tmpdir) == (0, b"hi\n")
+    assert cli._run_command_full(["echo", "hi"], tmpdir, capture=False) == (0, b"")
+    assert cli._run_command(["false"], tmpdir) == 1
+
+
+def test_render_config_vars(tmpdir):
+    tmpdir = Path(tmpdir)
+    paths = AppPaths.from_paths(Paths.for_workdir(tmpdir, tmpdir), "app")
+    paths.repo_dir.mkdir(parents=True)
+    compose_file = paths.repo_dir / "docker-compose.yml"
+    compose_file.write_text("image: {{ HM_IMAGE }}")
+
+    app = cli.App("app", {"url": "", "replacements": {"IMAGE": "foo"}}, paths, {})
+    app._render_config_vars()
+    assert compose_file.read_text() == "image: foo"
+
+    # An already rendered file shouldn't be written again.
+    mtime = compose_file.stat().st_mtime_ns
+    app._render_config_vars()
+    assert compose_file.stat().st_mtime_ns == mtime
+
+    # A changed file should be rendered again.
+    compose_file.write_text("image: {{ HM_IMAGE }}:latest")
+    app._render_config_vars()
+    assert compose_file.read_text() == "image: foo:latest"
+
+
+def test_run_command_environment(tmpdir, monkeypatch):
+    monkeypatch.setattr(cli, "DEBUG", False)
+    tmpdir = Path(tmpdir)
+
+    returncode, stdout = cli._run_command_full(
+        ["sh", "-c", 'echo "$FOO:$PWD"'], tmpdir, environment={"FOO": "bar"}
+    )
+    assert returncode == 0
+    assert stdout.decode().strip() == f"bar:{tmpdir}"
+
+
+def test_is_running(tmpdir):
+    tmpdir = Path(tmpdir)
+    paths = AppPaths.from_paths(Paths.for_workdir(tmpdir, tmpdir), "My.App")
+
+    app = cli.App("My.App", {"url": ""}, paths, {})
+    assert app.project_dir == str(paths.repo_dir)
+
+    app.running_project_dirs = {str(paths.repo_dir), "/other"}
+    assert app.is_running()
+
+    app = cli.App("My.App", {"url": "", "compose_config": "./apps/app.yml"}, paths, {})
+    assert app.project_dir == str(paths.repo_dir / "apps")
+    app.running_project_dirs = {str(paths.repo_dir / "apps")}
+    assert app.is_running()
+
+    # Apps missing from the snapshot should be looked up directly.
+    app.running_project_dirs = {"/other"}
+    with patch("docker_harbormaster.cli._run_command_full") as run:
+        run.return_value = (0, b"")
+        assert not app.is_running()
+        run.return_value = (0, b"web\n")
+        assert app.is_running()
+    assert run.call_args[0][0][2:] == [
+        "-f",
+        "./apps/app.yml",
+        "ps",
+        "--services",
+        "--filter",
+        "status=running",
+    ]
+
+
+def test_delete_in_background(tmpdir):
+    tmpdir = Path(tmpdir)
+    path = tmpdir / "repo"
+    (path / "subdir").mkdir(parents=True)
+    (path / "subdir" / "file").write_text("hi")
+
+    cli._delete_in_background(path, tmpdir / ".trash")
+    assert not path.exists()
+
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    assert list((tmpdir / ".trash").iterdir()) == []
+
+    # If the directory can't be moved to the trash, it should be deleted directly.
+    (path / "subdir").mkdir(parents=True)
+    with patch.object(Path, "rename", side_effect=OSError("Cross-device link")):
+        cli._delete_in_background(path, tmpdir / ".trash")
+    assert not path.exists()
+
+
+def test_write_atomically(tmpdir):
+    tmpdir = Path(tmpdir)
+    target = tmpdir / "target.yml"
+    target.write_text("old")
+    target.chmod(0o640)
+    link = tmpdir / "docker-compose.yml"
+    link.symlink_to(target)
+
+    # Symlinks and permissions should survive the rename.
+    cli._write_atomically(link, b"new")
+    assert link.is_symlink()
+    assert target.read_text() == "new"
+    assert target.stat().st_mode & 0o777 == 0o640
+
+    # Files that look like temporary files should be left alone.
+    (tmpdir / "new.json.tmp").write_text("mine")
+    cli._write_atomically(tmpdir / "new.json", "{}")
+    assert (tmpdir / "new.json").read_text() == "{}"
+    assert (tmpdir / "new.json.tmp").read_text() == "mine"
+    (tmpdir / "new.json.tmp").unlink()
+
+    # The temporary file should be cleaned up if writing fails.
+    with pytest.raises(TypeError):
+        cli._write_atomically(tmpdir / "new.json", None)  # type: ignore
+    assert (tmpdir / "new.json").read_text() == "{}"
+    assert sorted(p.name for p in tmpdir.iterdir()) == [
+        "docker-compose.yml",
+        "new.json",
+        "target.yml",
+    ]
+
+
+def test_remove_tree(tmpdir, capsys):
+    tmpdir = Path(tmpdir)
+    (tmpdir / "repo").mkdir()
+    (tmpdir / "repo" / "file").write_text("hi")
+
+    # Files that can't be deleted should be reported, rather than silently left behind.
+    with patch("os.unlink", side_effect=PermissionError("Permission denied")):
+        cli._remove_tree(tmpdir / "repo")
+    assert (tmpdir / "repo" / "file").exists()
+    output = capsys.readouterr().out
+    assert f"item(s) in {tmpdir / 'repo'}, the first error" in output
+    assert "Permission denied" in output
+
+
+def test_archive_stale_data_jobs(tmpdir):
+    tmpdir = Path(tmpdir)
+    paths = Paths.for_workdir(tmpdir, tmpdir)
+    paths.create_directories()
+    for name in ("app1", "app2", "app3"):
+        (paths.repos_dir / name).mkdir()
+
+    # With a single job, the stale repos should be removed one at a time.
+    threads = set()
+    with patch(
+        "docker_harbormaster.cli._kill_orphan_containers",
+        side_effect=lambda _: threads.add(threading.get_ident()),
+    ):
+        cli.archive_stale_data([], paths, jobs=1)
+    assert len(threads) == 1
+    assert cli._subdir_names(paths.repos_dir) == set()
+
+
+def test_subdir_names(tmpdir):
+    tmpdir = Path(tmpdir)
+    (tmpdir / "dir1").mkdir()
+    (tmpdir / "dir2").mkdir()
+    (tmpdir / "file").write_text("hi")
+
+    assert cli._subdir_names(tmpdir) == {"dir1", "dir2"}
+
+
+def test_buffered_output(capsys):
+    def worker(name):
+        with cli._buffered_output():
+            for i in range(50):
+                cli.echo(f"{name} {i}")
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in "ab"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    lines = capsys.readouterr().out.splitlines()
+    # Each thread's lines should be printed together.
+    assert sorted([lines[:50], lines[50:]]) == [
+        [f"a {i}" for i in range(50)],
+        [f"b {i}" for i in range(50)],
+    ]
+
+
+def test_options_to_dict():
+    assert options_to_dict(("FOO=bar", "BAZ=a=b", "EMPTY=")) == {
+        "FOO": "bar",
+        "BAZ": "a=b",
+        "EMPTY": "",
+    }
+    with pytest.raises(SystemExit):
+        options_to_dict(("FOO",))
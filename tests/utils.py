@@ -1,9 +1,10 @@
 import os
-from contextlib import contextmanager
+import shutil
 from pathlib import Path
 from typing import Any
 from typing import Dict
 from typing import Iterable
+from typing import Optional
 from typing import Set
 from typing import Tuple
 from unittest.mock import patch
@@ -15,22 +16,20 @@ from click.testing import CliRunner
 from docker_harbormaster import cli
 
 
-@contextmanager
-def chdir(path: Path):
-    """Sets the cwd within the context."""
-    origin = Path().absolute()
-    try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(origin)
-
-
 class Repository:
     def __init__(self, name: str, root_dir: Path, branch="master"):
         self._name = name
         self._root_dir = root_dir
         self._repo = git.Repo.init(root_dir / name)
+        # Don't let the user's global configuration (signing, hooks, etc) slow down or
+        # break committing.
+        with self._repo.config_writer() as config:
+            config.set_value("commit", "gpgsign", "false")
+            config.set_value("core", "hooksPath", os.devnull)
+            config.set_value("gc", "auto", "0")
+        self._repo.git.update_environment(
+            GIT_OPTIONAL_LOCKS="0", GIT_TERMINAL_PROMPT="0"
+        )
         self.checkout(branch)
 
     @property
@@ -40,17 +39,24 @@ class Repository:
 
     def add_files(self, contents: Iterable[Tuple[str, str]]) -> None:
         """Add a bunch of files to a repository and commit."""
-        with chdir(self.path):
-            for filename, content in contents:
-                with open(filename, "w") as outfile:
-                    outfile.write(content)
-                self._repo.index.add(filename)
+        for filename, content in contents:
+            path = self.path / filename
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+            # GitPython resolves relative paths against the repository root.
+            self._repo.index.add(filename)
         self._repo.index.commit("Commit")
 
+    def copy(self, root_dir: Path) -> "Repository":
+        """Copy the repository, with all its history, to another directory."""
+        shutil.copytree(self.path, root_dir / self._name, symlinks=True)
+        return Repository(self._name, root_dir, branch=self._repo.active_branch.name)
+
     def checkout(self, rev: str) -> None:
         """Check out a given revision."""
-        refs = [x.name for x in self._repo.references]
-        self._repo.git.checkout(rev, b=rev not in refs)
+        # Look up the branch directly, rather than listing all the references.
+        exists = git.Head(self._repo, f"refs/heads/{rev}").is_valid()
+        self._repo.git.checkout(rev, b=not exists)
 
 
 def mkdir(path: Path) -> Path:
@@ -59,16 +65,22 @@ def mkdir(path: Path) -> Path:
     return path
 
 
-def _patched_run():
-    """Mock _run_command_full so that we can get the commands."""
+def _patched_run(docker_outputs: Dict[str, bytes]):
+    """
+    Mock _run_command_full/_run_command_simple so that we can get the commands.
+
+    Docker commands output whatever `docker_outputs` has for them, or nothing.
+    """
     rcf = cli._run_command_full
 
     commands = []
 
     def inner(command, chdir, environment=None, **kwargs):
-        if "docker" in command and "compose" in command:
-            commands.append(" ".join(command))
-            return 0, b""
+        if command[0] == cli._DOCKER:
+            # Record the command with the plain name, wherever Docker is installed.
+            command_str = " ".join(["docker", *command[1:]])
+            commands.append(command_str)
+            return 0, docker_outputs.get(command_str, b"")
         else:
             return rcf(command, chdir, environment=environment)
 
@@ -78,10 +90,13 @@ def _patched_run():
 
 
 def run_harbormaster(
-    tmp_path: Path, repos: Dict[str, Repository]
+    tmp_path: Path,
+    repos: Dict[str, Repository],
+    args: Iterable[str] = (),
+    docker_outputs: Optional[Dict[str, bytes]] = None,
 ) -> Tuple[Any, Dict[str, Any]]:
     """I'm terribly sorry about this, it was the only way."""
-    rcf_mock, commands = _patched_run()
+    rcf_mock, commands = _patched_run(docker_outputs or {})
     fn_stop = cli.App.stop
     # Prepare a list of the functions' outputs.
     output: Dict[str, Set[str]] = {"restarted_apps": set()}
@@ -92,19 +107,27 @@ def run_harbormaster(
         return fn_stop(self, *args, **kwargs)
 
     with patch("docker_harbormaster.cli._run_command_full", side_effect=rcf_mock):
-        with patch.object(cli.App, "stop", stop_mock):
-            runner = CliRunner()
-            result = runner.invoke(
-                cli.cli,
-                [
-                    "--debug",
-                    "run",
-                    "--config",
-                    f"{repos['config'].path}/harbormaster.yml",
-                    "--working-dir",
-                    str(mkdir(tmp_path / "working_dir")),
-                ],
-            )
-            click.echo(result.stdout)
+        with patch("docker_harbormaster.cli._run_command_simple", side_effect=rcf_mock):
+            with patch.object(cli.App, "stop", stop_mock):
+                runner = CliRunner()
+                result = runner.invoke(
+                    cli.cli,
+                    [
+                        "--debug",
+                        "run",
+                        "--config",
+                        f"{repos['config'].path}/harbormaster.yml",
+                        "--working-dir",
+                        str(mkdir(tmp_path / "working_dir")),
+                        *args,
+                    ],
+                    # Let exceptions propagate, so failing tests show the traceback.
+                    catch_exceptions=False,
+                    color=False,
+                )
+                if result.exit_code != 0:
+                    # Only show the output of failed runs, as it's long and pytest
+                    # would capture it anyway.
+                    click.echo(result.output)
     output["commands"] = commands
     return result, output